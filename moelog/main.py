@@ -1,15 +1,70 @@
-import typing, logging, os, json
+import typing, logging, os, re, sys, json, time
 from moecolor import FormatText as ft
-from datetime import datetime
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# Non-ASCII characters (and DEL) are escaped like stdlib json's ensure_ascii, so streams with a narrow
+# encoding, e.g. a cp1252 Windows console, never fail to encode a record
+_NON_ASCII = re.compile('[\x7f-\U0010ffff]')
+
+def _escape_non_ascii(match):
+    code = ord(match.group())
+    if code < 0x10000:
+        return '\\u{0:04x}'.format(code)
+    code -= 0x10000
+    return '\\u{0:04x}\\u{1:04x}'.format(0xd800 | (code >> 10), 0xdc00 | (code & 0x3ff))
+
+def _json_dumps(obj):
+    return json.dumps(obj)
+
+def _orjson_dumps(obj):
+    # Hand datetimes, dataclasses and str/int/dict/list subclasses back as unsupported, so orjson accepts and
+    # rejects the same values as stdlib json. UUIDs are the exception, orjson always serializes them.
+    try:
+        text = orjson.dumps(obj, option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS |
+                                        orjson.OPT_PASSTHROUGH_SUBCLASS).decode()
+    except TypeError:
+        # e.g. non-str keys or integers above 64 bits, stdlib json either handles them or raises the same way
+        return json.dumps(obj, separators=(',', ':'))
+    return text if text.isascii() else _NON_ASCII.sub(_escape_non_ascii, text)
+
+def _ujson_dumps(obj):
+    return ujson.dumps(obj, ensure_ascii=True, escape_forward_slashes=False)
+
+# Prefer a C serializer for the JSON hot path when one is installed. They all produce the same JSON values,
+# but orjson and ujson write compact separators, e.g. {"a":1} instead of stdlib's {"a": 1}.
+_dumps = _orjson_dumps if orjson else _ujson_dumps if ujson else _json_dumps
+
 BASIC_LOGGING_FIELDS = {
     'log.level'   : '',  # 'Message log level, e.g. error, warning, timer, app_info. Automatically generated',
     '@timestamp'  : '',  # 'Timestamp in iso format, e.g 2023-02-17T23:16:41.220Z. Automatically generated',
     'message'     : ''   # 'Message containing log information, and the message format is: ' \
 }
 
+_VALID_LEVELS = frozenset({'DEBUG', 'INFO', 'ERROR', 'WARN', 'WARNING', 'CRITICAL', 'FATAL'})
+
+# Custom levels only need to be set up once per process
+_LEVELS_INITIALIZED = False
+# Level names already added through MoeLogger.addLoggingLevel
+_REGISTERED_LEVELS = set()
+
+# UTC day currently used to name log files, refreshed only when the day rolls over
+_DAY_KEY = -1
+_DAY_STR = ''
+
 class ConsoleFormatter(logging.Formatter):
+    default_time_format = "%Y-%m-%dT%H:%M:%S" # Setup iso8601 format
+    default_msec_format = '%s.%03dZ'
+    converter           = time.gmtime
+
     def __init__(self, fmt=None, datefmt=None, style='%', cfmt:str='', colors: str=[]):
         self.levels = {
             'DEBUG'     : ['yellow' , '#fff9ae'],
@@ -33,6 +88,17 @@ class ConsoleFormatter(logging.Formatter):
             self.base_attr = ' | %(name)s | %(funcName)s | LN%(lineno)d | %(levelname)s'
         self.message    = ' %(message)s'
         super().__init__(fmt=None, datefmt=None, style='%')
+        # Build the colored format strings once, cfmt uses the same format for every level
+        if self.cfmt:
+            _format = self.get_format(None, None)
+            self._fmt_by_level = dict.fromkeys(self.levels, _format)
+        else:
+            self._fmt_by_level = {level: self.get_format(level, None) for level in self.levels}
+        # One style per level, so records only need a lookup
+        self._styles = {level: logging.PercentStyle(_format) for level, _format in self._fmt_by_level.items()}
+        self._default_style = logging.PercentStyle(self.get_format(None, None))
+        # Set once so usesTime() reflects the level styles, which all agree on whether asctime is used
+        self._style = self._default_style
 
     def get_format(self, level, field: str=''):
         if self.cfmt:
@@ -46,27 +112,32 @@ class ConsoleFormatter(logging.Formatter):
         else:
             return self.asctime + attr_format + ' ] ' + self.message
 
-    def format(self, record):
-        _format = self.get_format(record.levelname, None)
-        formatter = logging.Formatter(_format)
-        return formatter.format(record)
+    def formatMessage(self, record):
+        return self._styles.get(record.levelname, self._default_style).format(record)
 
 class JSONFormatter(logging.Formatter):
     def __init__(self, logging_fields):
         self.logging_fields = logging_fields
+        # Fields are fixed after construction, keep only the ones mapped to a record attribute
+        self._field_pairs   = [(key, value) for key, value in logging_fields.items() if value]
+        # Same message layout as the file handler
+        self._tmpl          = '[%s | %s | LN%d]: %s'
+        # (second, prefix) of the last record, kept in one tuple so concurrent handlers never see a torn pair
+        self._last          = (-1, '')
+        super().__init__()
 
     def format(self, record):
-        message = f'[{record.name} | {record.funcName} | LN{record.lineno}]: {record.getMessage()}'
-        date_time = datetime.fromtimestamp(record.created)
-        isoformat = date_time.isoformat()[:-3] + 'Z'
-        _logging_fields = {}
-        _logging_fields['@timestamp']  = isoformat
-        _logging_fields['log.level']   = record.levelname
-        _logging_fields['message']     = message
-        for key, value in self.logging_fields.items():
-            if value:
-                _logging_fields[key]  = getattr(record, value, '')
-        return json.dumps(_logging_fields)
+        message = self._tmpl % (record.name, record.funcName, record.lineno, record.getMessage())
+        sec = int(record.created)
+        last_sec, prefix = self._last
+        if sec != last_sec:
+            prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(sec))
+            self._last = (sec, prefix)
+        isoformat = f'{prefix}.{int(record.msecs):03d}Z'
+        _logging_fields = {'@timestamp': isoformat, 'log.level': record.levelname, 'message': message}
+        for key, attr in self._field_pairs:
+            _logging_fields[key] = getattr(record, attr, '')
+        return _dumps(_logging_fields)
 
 class ExtraAttributes(logging.Filter):
     def __init__(self, **params):
@@ -74,18 +145,55 @@ class ExtraAttributes(logging.Filter):
         super().__init__()
 
     def filter(self, record):
-        for key, value in self.extra_attr.items():
-            record.__setattr__(key, value)
+        if self.extra_attr:
+            record.__dict__.update(self.extra_attr)
         return True
 
+class BufferedFileHandler(logging.FileHandler):
+    """FileHandler that batches writes in a larger buffer instead of flushing every record.
+
+    Records below ``flush_level`` stay in the buffer until it fills, a record at or above ``flush_level``
+    arrives, or the handler is flushed/closed (logging flushes all handlers at interpreter exit).
+    Trade-off: buffered records are not visible to ``tail -f`` right away and are lost on a hard crash
+    (SIGKILL, ``os._exit``), hence it is opt-in via ``MoeLogger(buffer_file=True)``.
+    """
+    def __init__(self, filename, mode='a', encoding=None, delay=False, buffer_size: int=64*1024,
+                 flush_level: int=logging.ERROR):
+        self.buffer_size = buffer_size
+        self.flush_level = flush_level
+        self._deferred   = False
+        super().__init__(filename, mode=mode, encoding=encoding, delay=delay)
+
+    def _open(self):
+        # FileHandler.errors only exists on Python 3.9+
+        return open(self.baseFilename, self.mode, buffering=self.buffer_size, encoding=self.encoding,
+                    errors=getattr(self, 'errors', None))
+
+    def emit(self, record):
+        # emit runs under the handler lock, so the flag only affects the flush issued by this record
+        self._deferred = record.levelno < self.flush_level
+        try:
+            super().emit(record)
+        finally:
+            self._deferred = False
+
+    def flush(self):
+        # Checked under the (reentrant) handler lock, so a flush from another thread waits for an in-flight
+        # emit to finish instead of being dropped
+        with self.lock:
+            if self._deferred:
+                return
+            super().flush()
+
 class MoeLogger:
     def __init__(self, json_format: bool=False, log_level: str='WARNING', logging_fields: typing.Dict={},
-                 log_to_file: bool=False, max_bytes: int=3*1024*1024) -> None:
+                 log_to_file: bool=False, max_bytes: int=3*1024*1024, buffer_file: bool=False) -> None:
         self._ecs_fields     = {}
         self.json_format     = json_format
         self.level           = log_level.upper()
         self.max_bytes       = max_bytes
         self.log_to_file     = log_to_file
+        self.buffer_file     = buffer_file
         self.file_handler    = None
         self.console_handler = logging.StreamHandler()
         self.logging_fields  = logging_fields
@@ -106,8 +214,7 @@ class MoeLogger:
 
     def _console_handler(self):
         self._console_formatter = JSONFormatter(self.logging_fields) if self.json_format else ConsoleFormatter()
-        self.level = self.level if self.level in ['DEBUG', 'INFO', 'ERROR', 'WARN',
-                                                  'WARNING', 'CRITICAL', 'FATAL'] else 'WARNING'
+        self.level = self.level if self.level in _VALID_LEVELS else 'WARNING'
         self.console_handler.setFormatter(self._console_formatter)
         self.console_handler.setLevel(self.level)
 
@@ -115,24 +222,39 @@ class MoeLogger:
         ext = 'log'
         logs_dir = Path('logs')
         logs_dir.mkdir(exist_ok=True)
-        timestamp = datetime.utcnow().strftime("%Y-%m-%d")
+        global _DAY_KEY, _DAY_STR
+        now = time.time()
+        day = int(now // 86400)
+        if day != _DAY_KEY:
+            t = time.gmtime(now)
+            _DAY_STR = f'{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d}'
+            _DAY_KEY = day
+        timestamp = _DAY_STR
         log_file = os.path.join(logs_dir, f'{timestamp}.{ext}')
-        # split file if it exists and greater than maxBytes
-        if os.path.isfile(log_file) and os.path.getsize(log_file) > self.max_bytes:
-            cnt = 1
-            while True:
-                log_file = os.path.join(logs_dir, f'{timestamp}.{cnt}.{ext}')
-                if os.path.isfile(log_file):
-                    cnt += 1
-                else:
-                    break
+        # split file if it exists and greater than maxBytes, a single stat unless a split is actually needed
+        try:
+            oversized = os.path.getsize(log_file) > self.max_bytes
+        except OSError:
+            oversized = False
+        if oversized:
+            # Next split index follows the highest existing {timestamp}.<n>.{ext}, found from names alone
+            split_name = re.compile(rf'{re.escape(timestamp)}\.(\d+)\.{re.escape(ext)}')
+            with os.scandir(logs_dir) as it:
+                indices = [int(match.group(1)) for match in map(split_name.fullmatch, (entry.name for entry in it))
+                           if match]
+            cnt = 1 + max(indices, default=0)
+            log_file = os.path.join(logs_dir, f'{timestamp}.{cnt}.{ext}')
         # Rollover mechanism, does not work like we need...
         # RotatingFileHandler(log_file, maxBytes=maxBytes, backupCount=backupCount)
         file_format= {'@timestamp': '%(asctime)s', 'app.name': '%(app_name)s', 'log.level': '%(levelname)s',
                       'message': '[%(name)s | %(funcName)s | LN%(lineno)d]: %(message)s'}
-        file_format = json.dumps(file_format, indent=4, separators=(",", ":"))
+        file_format = json.dumps(file_format, separators=(",", ":"))
         file_formatter = logging.Formatter(file_format)
-        self.file_handler = logging.FileHandler(log_file, mode='a+')
+        file_formatter.default_time_format = "%Y-%m-%dT%H:%M:%S" # Setup iso8601 format
+        file_formatter.default_msec_format = '%s.%03dZ'
+        file_formatter.converter           = time.gmtime
+        self.file_handler = BufferedFileHandler(log_file, mode='a+') if self.buffer_file else \
+                            logging.FileHandler(log_file, mode='a+')
         self.file_handler.setFormatter(file_formatter)
         self.file_handler.setLevel(logging.WARNING)
 
@@ -144,8 +266,10 @@ class MoeLogger:
 
     def _update_filter(self, **kwargs):
         # If filter exits -> update value, otherwise create new one
+        if not kwargs:
+            return
         add_filter = True
-        field, value = tuple(kwargs.items())[0]
+        field, value = next(iter(kwargs.items()))
         for _filter in self.console_handler.filters:
             if _filter.extra_attr.get(field, None) is not None:
                 # Update with new value
@@ -157,15 +281,18 @@ class MoeLogger:
             self._add_filter(**kwargs)
 
     def setup_logger(self):
-        # Universal setup for logger...
+        # Universal setup for logger, basicConfig is a no-op once the root logger has handlers
+        if logging.getLogger().hasHandlers():
+            return
         logging.basicConfig(handlers=[self.console_handler] if not self.file_handler else
                             [self.file_handler, self.console_handler], level=self.level)
 
     def configure_logging(self):
-        MoeLogger.addLoggingLevel('TIMER', logging.CRITICAL + 5)
-        MoeLogger.addLoggingLevel('APP_INFO', logging.CRITICAL + 6)
-        logging.Formatter.default_msec_format = '%s.%03dZ'
-        logging.Formatter.default_time_format = "%Y-%m-%dT%H:%M:%S" # Setup iso8601 format
+        global _LEVELS_INITIALIZED
+        if not _LEVELS_INITIALIZED:
+            MoeLogger.addLoggingLevel('TIMER', logging.CRITICAL + 5)
+            MoeLogger.addLoggingLevel('APP_INFO', logging.CRITICAL + 6)
+            _LEVELS_INITIALIZED = True
         if self.log_to_file:
             self._file_handler()
         self._console_handler()
@@ -187,6 +314,9 @@ class MoeLogger:
         if not methodName:
             methodName = levelName.lower()
 
+        if levelName in _REGISTERED_LEVELS:
+            logging.debug('{} already defined in logging module'.format(levelName))
+            return False
         if hasattr(logging, levelName):
             logging.debug('{} already defined in logging module'.format(levelName))
             return False
@@ -201,12 +331,16 @@ class MoeLogger:
             if self.isEnabledFor(levelNum):
                 self._log(levelNum, message, args, **kwargs)
         def logToRoot(message, *args, **kwargs):
-            logging.log(levelNum, message, *args, **kwargs)
+            if logging.getLogger().isEnabledFor(levelNum):
+                logging.log(levelNum, message, *args, **kwargs)
 
+        # Intern the name so record.levelname lookups in the formatters hit on identity
+        levelName = sys.intern(levelName)
         logging.addLevelName(levelNum, levelName)
         setattr(logging, levelName, levelNum)
         setattr(logging.getLoggerClass(), methodName, logForLevel)
         setattr(logging, methodName, logToRoot)
+        _REGISTERED_LEVELS.add(levelName)
         return True
 
 
@@ -1,13 +1,13 @@
 import os
 from setuptools import setup, find_packages
-from pip._internal.network.session import PipSession
-from pip._internal.req.req_file import parse_requirements
 from moelog.version import __version__
 VERSION = __version__
 PROJECT_DIR = os.path.dirname(os.path.realpath(__file__))
-REQUIREMENTS = parse_requirements(os.path.join(PROJECT_DIR, 'requirements.txt'), session=PipSession())
+with open(os.path.join(PROJECT_DIR, 'requirements.txt')) as f:
+    REQUIREMENTS = [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
 DESCRIPTION = 'Python Libary to provide convenient logging mechanism.'
-LONG_DESCRIPTION = open('README.md').read()
+with open(os.path.join(PROJECT_DIR, 'README.md'), encoding='utf-8') as f:
+    LONG_DESCRIPTION = f.read()
 setup(
     name="moelog",
     version=VERSION,
@@ -18,7 +18,7 @@ setup(
     long_description_content_type="text/markdown",
     long_description=LONG_DESCRIPTION,
     packages=find_packages(),
-    install_requires=[str(ir.requirement) for ir in REQUIREMENTS],
+    install_requires=REQUIREMENTS,
     keywords=['python', 'color', 'terminal', 'text', 'styling', 'ansi',
               'coloring text', 'text styling', 'text formatting', 'formatting'],
     classifiers=[
@@ -0,0 +1,139 @@
+import os, json, time, logging, datetime, dataclasses, threading
+import pytest
+from moelog import main
+from moelog.main import MoeLogger, ConsoleFormatter, JSONFormatter, BufferedFileHandler
+
+
+def _file_logger(tmp_path, monkeypatch, **kwargs):
+    monkeypatch.chdir(tmp_path)
+    logger = MoeLogger(log_to_file=True, **kwargs)
+    return logger, tmp_path / 'logs'
+
+
+def test_split_file_index_follows_highest_existing_split(tmp_path, monkeypatch):
+    logger, logs_dir = _file_logger(tmp_path, monkeypatch)
+    day = os.path.basename(logger.file_handler.baseFilename).split('.')[0]
+    logger.file_handler.close()
+    (logs_dir / f'{day}.log').write_bytes(b'x' * 64)
+    (logs_dir / f'{day}.1.log').touch()
+    (logs_dir / f'{day}.3.log').touch()
+    (logs_dir / f'{day}.9.gz').touch()
+
+    logger, _ = _file_logger(tmp_path, monkeypatch, max_bytes=32)
+    try:
+        assert logger.file_handler.baseFilename == str(logs_dir / f'{day}.4.log')
+    finally:
+        logger.file_handler.close()
+
+
+def test_buffered_file_handler_defers_below_flush_level(tmp_path):
+    log_file = tmp_path / 'buffered.log'
+    handler = BufferedFileHandler(str(log_file), mode='a+')
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger = logging.getLogger('moelog.test.buffered')
+    logger.propagate = False
+    logger.addHandler(handler)
+    try:
+        logger.warning('first')
+        assert log_file.read_text() == ''
+        logger.error('second')
+        assert log_file.read_text() == 'first\nsecond\n'
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+
+
+def test_buffered_file_handler_flush_waits_for_inflight_emit(tmp_path):
+    entered, release = threading.Event(), threading.Event()
+
+    class BlockingFormatter(logging.Formatter):
+        def format(self, record):
+            entered.set()
+            release.wait(5)
+            return super().format(record)
+
+    log_file = tmp_path / 'buffered.log'
+    handler = BufferedFileHandler(str(log_file), mode='a+')
+    handler.setFormatter(BlockingFormatter('%(message)s'))
+    record = logging.LogRecord('moelog.test', logging.WARNING, __file__, 1, 'pending', None, None)
+    emitter = threading.Thread(target=handler.handle, args=(record,))
+    flusher = threading.Thread(target=handler.flush)
+    try:
+        emitter.start()
+        assert entered.wait(5)
+        flusher.start()
+        flusher.join(0.1)
+        assert flusher.is_alive()
+        release.set()
+        emitter.join(5)
+        flusher.join(5)
+        assert log_file.read_text() == 'pending\n'
+    finally:
+        release.set()
+        handler.close()
+
+def test_file_buffering_is_opt_in(tmp_path, monkeypatch):
+    logger, _ = _file_logger(tmp_path, monkeypatch)
+    buffered, _ = _file_logger(tmp_path, monkeypatch, buffer_file=True)
+    try:
+        assert not isinstance(logger.file_handler, BufferedFileHandler)
+        assert isinstance(buffered.file_handler, BufferedFileHandler)
+    finally:
+        logger.file_handler.close()
+        buffered.file_handler.close()
+
+
+@pytest.mark.skipif(not hasattr(time, 'tzset'), reason='time.tzset is not available on this platform')
+def test_formatters_render_utc_timestamps(tmp_path, monkeypatch):
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    logger = None
+    try:
+        logger, _ = _file_logger(tmp_path, monkeypatch)
+        record = logging.LogRecord('moelog.test', logging.WARNING, __file__, 1, 'utc', None, None)
+        record.created, record.msecs, record.app_name = 1700000000.123, 123.0, 'test'
+        expected = '2023-11-14T22:13:20.123Z'
+        assert expected in ConsoleFormatter().format(record)
+        assert json.loads(JSONFormatter({}).format(record))['@timestamp'] == expected
+        assert json.loads(logger.file_handler.formatter.format(record))['@timestamp'] == expected
+    finally:
+        if logger:
+            logger.file_handler.close()
+        monkeypatch.undo()
+        time.tzset()
+
+
+_DUMPS_BRANCHES = [
+    pytest.param('_orjson_dumps', 'orjson', id='orjson'),
+    pytest.param('_ujson_dumps', 'ujson', id='ujson'),
+    pytest.param('_json_dumps', None, id='stdlib'),
+]
+
+
+@pytest.mark.parametrize('func, module', _DUMPS_BRANCHES)
+def test_dumps_escapes_non_ascii(func, module):
+    if module:
+        pytest.importorskip(module)
+    value = {'message': 'ok ✓ a/b \U0001f600', 'app': 'moelog'}
+    text = getattr(main, func)(value)
+    assert text.isascii()
+    assert '\\u2713' in text and '\\ud83d\\ude00' in text and 'a/b' in text
+    assert json.loads(text) == value
+
+
+@pytest.mark.parametrize('func, module', _DUMPS_BRANCHES)
+def test_dumps_rejects_values_stdlib_json_rejects(func, module):
+    if module:
+        pytest.importorskip(module)
+
+    @dataclasses.dataclass
+    class Extra:
+        value: int = 1
+
+    for value in (datetime.datetime(2023, 11, 14), Extra(), object()):
+        with pytest.raises(TypeError):
+            getattr(main, func)({'extra': value})
+
+
+def test_stdlib_dumps_keeps_default_separators():
+    assert main._json_dumps({'a': 1, 'b': 'x'}) == '{"a": 1, "b": "x"}'